@@ -5,7 +5,10 @@ Async container for curses.
 __version__ = '0.1.0'
 
 import curses
-from asyncio import Event, sleep
+from asyncio import Event, Queue, create_task, get_running_loop
+from os import get_terminal_size
+from signal import SIGWINCH
+from sys import stdin, stdout
 
 from zenlib.logging import loggify
 
@@ -22,39 +25,81 @@ class CursesContainer:
         self.mode = 'main'
         self.modes = {'m': self.mode}
         self.stop = Event()
+        self.key_queue = Queue()
+        self.damaged = Event()  # Set when the screen needs to be redrawn
+        self.damaged.set()  # Draw the first frame
+        self.popup = None  # The (title, text, options) of the popup waiting for input
+        self.stdscr = None  # Set by init_curses
+        self._watching_stdin = False  # Set once the stdin reader is added to the event loop
+        self._watching_resize = False  # Set once the SIGWINCH handler is added to the event loop
+        self._frame_state = None  # The (title, mode, rows, cols) the frame was last drawn with
+        # Map mode names to their mode_<name> and process_key_<name> methods
+        self._mode_handlers = self._get_handlers('mode_')
+        self._key_handlers = self._get_handlers('process_key_')
+
+    def _get_handlers(self, prefix):
+        """ Returns a dict of the methods starting with the prefix, keyed by the rest of the method name. """
+        return {name.removeprefix(prefix): getattr(self, name) for name in dir(type(self)) if name.startswith(prefix)}
+
+    def _get_key_modes(self):
+        """ Resolves the mode name each key in self.modes switches to, for either case of the key. """
+        key_modes = {}
+        for key, mode in self.modes.items():
+            mode = mode.replace(' ', '_')
+            if mode not in self._mode_handlers:
+                self.logger.error(f"Mode {mode} not found.")
+                continue
+            key_modes[key.lower()] = key_modes[key.upper()] = mode
+        return key_modes
 
     async def run(self):
-        """ Initialize curses, run the mainloop forever. """
-        self.init_curses()
-        self.additional_run()
-        while not self.stop.is_set():
-            await self.mainloop()
-        self.clean_curses()
+        """ Initialize curses, run the mainloop until stopped, always restoring the terminal like curses.wrapper. """
+        self._key_modes = self._get_key_modes()  # Resolved here, once subclasses have added their modes
+        input_task = None
+        try:
+            self.init_curses()
+            input_task = create_task(self.handle_input())
+            self.additional_run()
+            while not self.stop.is_set():
+                await self.damaged.wait()  # Only draw a frame once something changed
+                self.damaged.clear()
+                if self.stop.is_set():
+                    break
+                await self.mainloop()
+        finally:
+            if input_task:
+                input_task.cancel()
+            self.clean_curses()
 
     def additional_run(self):
         """ override this method to add additional functionality to the run method. """
         pass
 
     def init_curses(self):
-        """ Initialize curses. """
-        try:
-            stdscr = curses.initscr()
-            if curses.has_colors():
-                self._init_colors()
-            else:
-                self.logger.warning('No color support.')
-
-            stdscr.keypad(True)  # Enable keypad mode, for arrow keys
-            stdscr.nodelay(True)  # Non-blocking input
-            curses.noecho()
-            curses.cbreak()
-            curses.curs_set(0)
+        """
+        Initialize curses, in a single setup pass.
+        Uses raw mode, so ctrl-c is read as a key instead of raising KeyboardInterrupt.
+        """
+        self.stdscr = curses.initscr()
+        curses.noecho()
+        curses.raw()
+        self.stdscr.keypad(True)  # Enable keypad mode, for arrow keys
+        self.stdscr.nodelay(True)  # Non-blocking input
+        curses.set_escdelay(25)  # Don't stall the event loop waiting for the rest of an escape sequence
+        curses.curs_set(0)
+
+        if curses.has_colors():
+            self._init_colors()
+        else:
+            self.logger.warning('No color support.')
+            self.color_pairs = [0] * 256  # Draw everything with the default attrs
 
-            self.stdscr = stdscr
-            self.logger.info('Curses initialized.')
-        except KeyboardInterrupt:
-            self.logger.info("Detected KeyboardInterrupt, stopping main thread.")
-            self.stop.set()
+        self.get_screen_size()
+        get_running_loop().add_reader(stdin.fileno(), self._on_stdin_ready)  # Wake when a key is available
+        self._watching_stdin = True
+        get_running_loop().add_signal_handler(SIGWINCH, self._on_resize)  # Wake when the terminal is resized
+        self._watching_resize = True
+        self.logger.info('Curses initialized.')
 
     def _init_colors(self):
         """ Initializes the colors for curses. """
@@ -63,82 +108,127 @@ class CursesContainer:
         curses.use_default_colors()
         for i in range(0, curses.COLORS):
             curses.init_pair(i + 1, i, -1)  # offset by 1 to avoid 0
+        self.color_pairs = [curses.color_pair(i) for i in range(256)]  # Cache the attrs, indexed by pair number
 
     def clean_curses(self):
-        """ Cleans the curses session. """
+        """
+        Cleans the curses session.
+        Only undoes the parts of init_curses which were done, so it can be called after a failed setup.
+        """
         self.logger.info('Cleaning curses.')
-        curses.echo()
-        curses.nocbreak()
-        curses.curs_set(1)
-        curses.endwin()
+        if self._watching_stdin:
+            get_running_loop().remove_reader(stdin.fileno())
+            self._watching_stdin = False
+        if self._watching_resize:
+            get_running_loop().remove_signal_handler(SIGWINCH)
+            self._watching_resize = False
+        if self.stdscr is None:
+            return  # initscr failed or was never called
+
+        try:
+            self.stdscr.keypad(False)
+            curses.echo()
+            curses.noraw()
+            curses.curs_set(1)
+        finally:
+            curses.endwin()  # Always leave curses mode
+            self.stdscr = None
 
     async def mainloop(self):
         """ Main loop for the curses window. """
         self.draw_base_screen()  # Draw the base screen
 
-        if hasattr(self, f"mode_{self.mode}"):  # Process the current mode
+        if mode_handler := self._mode_handlers.get(self.mode):  # Process the current mode
             try:
-                getattr(self, f"mode_{self.mode}")()
+                mode_handler()
             except Exception as e:
                 self.logger.exception(e)
         else:
             self.logger.error(f"Mode {self.mode} not found.")
 
-        await self.handle_input()
-        self.stdscr.refresh()
+        self.stdscr.noutrefresh()  # Stage the changes in the virtual screen
+        if self.popup:
+            self.draw_popup()  # Keep the popup over the rest of the frame
+        curses.doupdate()  # Send only the changed cells to the terminal
 
     def mode_main(self):
         """ Code for handling the main mode. """
         pass
 
-    async def get_input(self):
-        """ Gets a character from the user. """
-        while not self.stop.is_set():
+    def _on_stdin_ready(self):
+        """
+        Reads all available keys into the key queue, called by the event loop when stdin is readable.
+        ctrl-c, read as a key in raw mode, stops immediately, even while a popup is waiting for input.
+        """
+        while True:
             try:
-                char = self.stdscr.getkey()
+                key = self.stdscr.getkey()
             except curses.error:
-                self.logger.log(5, "No key pressed before timeout.")
-                await sleep(0.05)
-            else:
+                self.logger.log(5, "No more keys available.")
+                break
+            if key == '\x03':
+                self.logger.warning("Got ctrl-c, stopping.")
+                self.stop.set()
+                self.damaged.set()
                 break
-        self.logger.debug("Key pressed: %s" % char)
+            self.key_queue.put_nowait(key)
+
+    async def get_input(self):
+        """ Gets a character from the user. """
+        char = await self.key_queue.get()
+        self.logger.debug("Key pressed: %s", char)
         return char
 
     async def handle_input(self):
-        """ Gets the input from the user. """
-        await self.process_key(await self.get_input())
+        """ Processes the input from the user until stopped, marking the screen as damaged after each key. """
+        while not self.stop.is_set():
+            try:
+                await self.process_key(await self.get_input())
+            except Exception as e:
+                self.logger.exception(e)
+            self.damaged.set()
 
     async def process_key(self, key):
         """  Process the pressed key. """
-        if key.lower() == 'q':
+        if key == 'KEY_RESIZE':  # Resizes are handled by _on_resize
+            return
+
+        if key in ('q', 'Q'):
             if await self.popup_window('Quit?', 'Are you sure you want to quit?', options=['y', 'n']) == 'y':
                 self.stop.set()
                 self.logger.warning("Got stop signal.")
-                return
+            return
 
-        if hasattr(self, f"process_key_{self.mode}"):
+        if key_handler := self._key_handlers.get(self.mode):
             try:
-                if getattr(self, f"process_key_{self.mode}")(key):
+                if key_handler(key):
                     return  # If the mode returns True, stop processing
             except Exception as e:
                 self.logger.exception(e)
 
-        if key.lower() in self.modes:
-            mode = self.modes[key.lower()].replace(' ', '_')
-            if not hasattr(self, f"mode_{mode}"):
-                self.logger.error(f"Mode {mode} not found.")
-            else:
-                self.logger.info("Changing mode to %s" % mode)
-                self.mode = mode
+        if mode := self._key_modes.get(key):
+            self.logger.info("Changing mode to %s", mode)
+            self.mode = mode
         else:
-            self.logger.warning("Invalid key: %s" % key)
+            self.logger.warning("Invalid key: %s", key)
 
     def draw_base_screen(self):
-        self.get_screen_size()  # Get the screen size
-        self.stdscr.clear()    # Clear the screen
-        self.stdscr.box()    # Draw a box around the screen
-        self.draw_title()   # Draw the title
-        self.draw_mode()    # Draw the mode
+        """
+        Draws the box, title, and mode bar when any of them changed since the last frame.
+        Otherwise only the area inside the box is erased.
+        """
+        frame_state = (self.title, self.mode, self.rows, self.cols)
+        if frame_state != self._frame_state:
+            self.stdscr.erase()    # Erase the screen, without forcing a full repaint
+            self.stdscr.box()    # Draw a box around the screen
+            self.draw_title()   # Draw the title
+            self.draw_mode()    # Draw the mode
+            self.body = self.stdscr.derwin(self.rows - 2, self.cols - 2, 1, 1)  # The area inside the box
+            self.body.syncok(True)  # Mark erased lines as changed in stdscr too
+            self._frame_state = frame_state
+        else:
+            self.body.erase()
+            self.stdscr.vline(1, 0, curses.ACS_VLINE, self.rows - 2)  # Restore the left border, modes may draw markers on it
 
     def draw_mode(self):
         """
@@ -150,7 +240,7 @@ class CursesContainer:
         offset = 1
         for key, mode in self.modes.items():
             if key == mode[0]:
-                self.stdscr.addstr(self.rows - 1, offset, mode[0], curses.color_pair(21))
+                self.stdscr.addstr(self.rows - 1, offset, mode[0], self.color_pairs[21])
                 offset += 1
                 modestr = mode[1:] + ' '
                 self.stdscr.addnstr(self.rows - 1, offset, modestr, self.cols - 2 - offset)
@@ -166,15 +256,63 @@ class CursesContainer:
         """ Draws the title, centered to the top of the screen. """
         self.stdscr.addnstr(0, self.cols // 2 - len(self.title) // 2, self.title, self.cols - 2)
 
+    def draw_segments(self, row, segments, window=None):
+        """
+        Draws a row made of (column, text, attr) segments, on stdscr unless another window is passed.
+        Gaps between segments are padded with spaces, and adjacent segments sharing an attr are joined,
+        so each run of a single attr is drawn with one addnstr call.
+        """
+        window = window or self.stdscr
+        runs = []
+        for col, text, attr in segments:
+            if runs:
+                run_col, run_text, run_attr = runs[-1]
+                run_text = run_text[:col - run_col].ljust(col - run_col)  # Pad gaps, overlapped text is overwritten
+                if run_attr == attr:
+                    runs[-1] = (run_col, run_text + text, attr)
+                    continue
+                runs[-1] = (run_col, run_text, run_attr)
+            runs.append((col, text, attr))
+
+        limit = window.getmaxyx()[1] - 1  # Don't draw over the right border
+        for col, text, attr in runs:
+            if col < limit:
+                window.addnstr(row, col, text, limit - col, attr)
+
     def get_screen_size(self):
         """ Get the screen size. """
         self.rows, self.cols = self.stdscr.getmaxyx()
 
+    def _on_resize(self):
+        """ Resizes curses to the new terminal size, called by the event loop on SIGWINCH. """
+        columns, lines = get_terminal_size(stdout.fileno())
+        curses.resizeterm(lines, columns)
+        curses.update_lines_cols()
+        self.get_screen_size()
+        self.logger.info("Screen resized to %sx%s", self.cols, self.rows)
+        self.damaged.set()
+
     async def popup_window(self, title='Popup', text='Text', options=None):
         """
-        Creates a popup window.
-        Waits for input and returns it.
+        Creates a popup window, which is drawn over each frame until it gets input.
+        Waits for input, from the same key queue as get_input, and returns it.
+        If options are passed, waits until one of them is pressed.
         """
+        self.popup = (title, text, options)
+        self.damaged.set()
+        try:
+            while True:
+                key = await self.get_input()
+                if not options or key.lower() in options:
+                    return key
+                self.logger.debug("Invalid option: %s", key)
+        finally:
+            self.popup = None
+            self.damaged.set()
+
+    def draw_popup(self):
+        """ Draws the current popup, centered on the screen. """
+        title, text, options = self.popup
         popup_height = 5
         popup_width = max(len(title), len(text) + 2) + 2
         popup_x = self.cols // 2 - popup_width // 2
@@ -182,7 +320,7 @@ class CursesContainer:
 
         popup = self.stdscr.derwin(popup_height, popup_width, popup_y, popup_x)
 
-        popup.clear()
+        popup.erase()
         popup.box()
         popup.addnstr(0, popup_width // 2 - len(title) // 2, title, popup_width - 2)
         popup.addnstr(2, 2, text, popup_width - 2)
@@ -190,22 +328,12 @@ class CursesContainer:
         if options == ['y', 'n']:
             # Draw a green 'y' and a red 'n' on the bottom line
 
-            popup.addstr(popup_height - 1, popup_width // 2, 'y', curses.color_pair(3))
-            popup.addstr(popup_height - 1, popup_width // 2 + 2, 'n', curses.color_pair(2))
-        else:
+            popup.addstr(popup_height - 1, popup_width // 2, 'y', self.color_pairs[3])
+            popup.addstr(popup_height - 1, popup_width // 2 + 2, 'n', self.color_pairs[2])
+        elif options:
             # Draw a centered prompt on the bottom line, containing the possible options
             prompt = '-'.join(options)
             prompt = f"[{prompt}]"
             popup.addnstr(popup_height - 1, popup_width // 2 - len(prompt) // 2, prompt, popup_width - 2)
-        popup.refresh()
-        self.popup = popup
-
-        if options:
-            key = await self.get_input()
-            if key.lower() in options:
-                return key
-            else:
-                self.logger.debug("Invalid option: %s" % key)
-        else:
-            return await self.get_input()
+        popup.noutrefresh()
 
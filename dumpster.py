@@ -6,129 +6,226 @@ acts on them.
 __version__ = '0.1.0'
 
 import curses
+from asyncio import create_task, sleep
+from collections import deque
+from itertools import chain
+from queue import Empty
 
 from netfilter import NetfilterLogReader
 from curses_container import CursesContainer
 
 
 class Dumpster(CursesContainer):
+    # Display values stored for each log item, in draw order.
+    # Ports are stored with their ':' separator, ready to be drawn after the IP.
+    LOG_COLUMNS = ('timestamp', 'hostname', 'log_type', 'src_mac', 'src_ip', 'src_port', 'dst_mac', 'dst_ip', 'dst_port')
+    MAX_LOG_ITEMS = 10000  # Number of log items kept, the oldest are dropped first
+    LOG_PAD_ROWS = 1024  # Number of rendered log items kept in the log pad
+    LOG_PAD_COLS = 256  # Width of the log pad, longer rows are cut off
+    # The (source, destination) color pairs used for each direction, each as (direction/port, mac, ip)
+    DIRECTION_COLORS = {'inbound': ((197, 125, 161), (46, 27, 34)),
+                        'outbound': ((46, 27, 34), (197, 125, 161))}
+    FORWARD_COLORS = ((203, 71, 83), (23, 209, 221))  # Used for any other direction
+    MAX_QUEUE_BATCHES = 16  # Maximum number of queued batches processed at once
+    LOG_REDRAW_INTERVAL = 0.1  # Minimum number of seconds between redraws caused by new log items
+
     def __init__(self, *args, **kwargs):
         super().__init__(title='Dumpster', *args, **kwargs)
 
-        self.log_items = []
+        self.log_columns = {column: deque(maxlen=self.MAX_LOG_ITEMS) for column in self.LOG_COLUMNS}
+        # Log positions count every item ever added, the columns hold the items from log_start to log_count
+        self.log_count = 0
+        self.log_start = 0
+        self.host_width = 0  # Length of the longest hostname seen
         self.log_pos = 0
         self.log_offset = 0
 
+        self.log_pad = None  # Created once curses is initialized
+        self.pad_start = 0  # Index of the log item on the first row of the log pad
+        self.pad_end = None  # Index after the last log item rendered into the log pad
+        self.pad_host_width = 0  # Hostname column width the log pad was rendered with
+
         self.log_reader = NetfilterLogReader(logger=self.logger)
+        # Don't queue more items than the log columns can hold
+        self.log_reader.MAX_QUEUED_BATCHES = -(-self.MAX_LOG_ITEMS // self.log_reader.LOG_BATCH_SIZE)
         self.modes['l'] = 'log view'
 
     def additional_run(self):
         self.log_reader.watch_logs()
+        create_task(self.watch_log_event())
+
+    async def watch_log_event(self):
+        """
+        Moves new items from the log reader's queue to the log columns whenever it queues them, in every mode,
+        so the queue doesn't grow while the log view isn't open.
+        The screen is only marked as damaged if the log view is displayed.
+        Waits LOG_REDRAW_INTERVAL after each redraw, so a stream of batches is drawn together instead of one frame per batch.
+        """
+        while not self.stop.is_set():
+            await self.log_reader.log_event.wait()
+            self.log_reader.log_event.clear()
+            while self.process_log_queue():
+                await sleep(0)  # More batches may be queued, let input and the readers run before taking them
+            if self.mode == 'log_view':
+                self.damaged.set()
+                await sleep(self.LOG_REDRAW_INTERVAL)
+
+    def add_log_item(self, log_item):
+        """ Adds the display values of a log item to the end of the log columns. """
+        values = {'timestamp': log_item.timestamp,
+                  'hostname': log_item.hostname,
+                  'log_type': log_item.log_type,
+                  'src_mac': log_item.display_src_mac(),
+                  'src_ip': log_item.display_src_ip(),
+                  'src_port': f":{log_item.display_src_port()}",
+                  'dst_mac': log_item.display_dst_mac(),
+                  'dst_ip': log_item.display_dst_ip(),
+                  'dst_port': f":{log_item.display_dst_port()}"}
+        for column, value in values.items():
+            self.log_columns[column].append(value)
+        self.log_count += 1
+        self.host_width = max(self.host_width, len(log_item.hostname))
 
     def process_log_queue(self):
-        """ Reads the items from the  log_reader.log_items queue and adds them to self.log_items. """
-        if not self.log_reader.log_items.empty():
-            self.logger.debug("Processing log queue.")
-            while not self.log_reader.log_items.empty():
-                self.log_items.append(self.log_reader.log_items.get())
-            self.logger.debug("Finished processing log queue.")
-        self.logger.log(5, "Log queue empty.")
+        """
+        Moves the batches of items from the log_reader.log_items queue to the log columns.
+        The queue is drained with get_nowait() until it's empty, instead of checking empty() before each get().
+        At most MAX_QUEUE_BATCHES batches are taken per call, so a backlog doesn't hold up input.
+        Returns True if the limit was reached, so more batches may be queued.
+        """
+        log_queue = self.log_reader.log_items
+        batches = []
+        try:
+            while len(batches) < self.MAX_QUEUE_BATCHES:
+                batches.append(log_queue.get_nowait())
+        except Empty:
+            limited = False
+        else:
+            limited = True
+
+        if not batches:
+            self.logger.log(5, "Log queue empty.")
+            return False
+
+        try:
+            for log_item in chain.from_iterable(batches):
+                try:
+                    self.add_log_item(log_item)
+                except Exception as e:  # Skip the item, instead of losing the rest of the batches taken off the queue
+                    self.logger.error("Unable to add log item: %s", e)
+        finally:
+            self.log_start = self.log_count - len(self.log_columns['timestamp'])  # Skip past dropped items
+        self.logger.debug("Processed log queue.")
+        return limited
+
+    def render_log_rows(self, start, end):
+        """ Draws the log items from start to end into the log pad, skipping items which were already dropped. """
+        start = max(start, self.log_start)
+        self.logger.log(5, "Rendering log items from %s to %s", start, end)
+
+        (timestamps, hostnames, directions, src_macs, src_ips, src_ports,
+         dst_macs, dst_ips, dst_ports) = self.log_columns.values()
+        trace = self.logger.isEnabledFor(5)  # Checked once, instead of calling the logger for every row
+        base_offset = 20 + self.host_width  # 19 comes from the timestamp width
+
+        # Resolve the direction color pairs to attrs once for the batch
+        color_pairs = self.color_pairs
+        forward_attrs = tuple(tuple(color_pairs[color] for color in colors) for colors in self.FORWARD_COLORS)
+        direction_attrs = {direction: tuple(tuple(color_pairs[color] for color in colors) for colors in color_sets)
+                           for direction, color_sets in self.DIRECTION_COLORS.items()}
+
+        # Index straight into the columns, instead of slicing copies of them
+        for index in range(start, end):
+            i = index - self.log_start  # Position of the item in the columns
+            src_ip, dst_ip = src_ips[i], dst_ips[i]
+            if trace:
+                self.logger.log(5, "[%s] Rendering log item: %s %s -> %s", index, timestamps[i], src_ip, dst_ip)
+
+            # Set the colors based on the direction/type
+            direction = directions[i]
+            src_attrs, dst_attrs = direction_attrs.get(direction, forward_attrs)
+
+            self.draw_segments(index - self.pad_start, [(1, timestamps[i], color_pairs[12]),
+                                                        (20, hostnames[i], color_pairs[59]),
+                                                        # Source information
+                                                        (base_offset + 1, direction, src_attrs[0]),
+                                                        (base_offset + 10, src_macs[i], src_attrs[1]),
+                                                        (base_offset + 28, src_ip, src_attrs[2]),
+                                                        (base_offset + 28 + len(src_ip), src_ports[i], src_attrs[0]),
+                                                        # Destination information
+                                                        (base_offset + 50, dst_macs[i], dst_attrs[1]),
+                                                        (base_offset + 68, dst_ip, dst_attrs[2]),
+                                                        (base_offset + 68 + len(dst_ip), dst_ports[i], dst_attrs[0])],
+                               window=self.log_pad)
+
+    def update_log_pad(self):
+        """
+        Renders any log items which aren't in the log pad yet.
+        The pad holds up to LOG_PAD_ROWS items, starting from self.pad_start.
+        It's rebuilt around the current offset when the view leaves that range, or the hostname column width changes.
+        """
+        view_end = min(self.log_count, self.log_offset + self.rows - 2)
+        if self.log_pad is None:
+            self.log_pad = curses.newpad(self.LOG_PAD_ROWS, self.LOG_PAD_COLS)
+            self.pad_end = None
+
+        if self.pad_end is None or self.pad_host_width != self.host_width \
+                or self.log_offset < self.pad_start or view_end > self.pad_start + self.LOG_PAD_ROWS:
+            self.pad_start = max(self.log_start, self.log_offset - self.LOG_PAD_ROWS // 2)
+            self.pad_end = self.pad_start
+            self.pad_host_width = self.host_width
+            self.log_pad.erase()
+            self.logger.debug("Rebuilding the log pad from %s", self.pad_start)
+
+        end = min(self.log_count, self.pad_start + self.LOG_PAD_ROWS)
+        if end > self.pad_end:
+            self.render_log_rows(self.pad_end, end)
+            self.pad_end = end
 
     def mode_log_view(self):
-        """  Displays the log items. """
-        def display_log():
-            """  Displays the log items.  """
-            # Draws the arrow in the left margin
-            self.stdscr.addstr(self.log_pos - self.log_offset + 1, 0, '➤', curses.color_pair(6))
-            self.logger.log(5, "Drawing log items from %s to %s" % (self.log_offset, min(len(self.log_items), self.rows - 2) + self.log_offset))
-
-            log_items = self.log_items[self.log_offset:min(len(self.log_items), self.rows - 2) + self.log_offset]
-            host_width = max([len(log_item.hostname) for log_item in log_items])
-            base_offset = 20 + host_width  # 19 comes from the timestamp width
-
-            color_set_red = (197, 125, 161)
-            color_set_green = (46, 27, 34)
-            color_set_f_src = (203, 71, 83)
-            color_set_f_dst = (23, 209, 221)
-
-            for i, log_item in enumerate(log_items):
-                self.logger.log(5, "[%s] Displaying log item: %s" % (i, log_item))
-
-                # Draw the timestamp
-                self.stdscr.addstr(i + 1, 1, log_item.timestamp, curses.color_pair(12))
-
-                # Draw the hostname
-                self.stdscr.addstr(i + 1, 20, log_item.hostname, curses.color_pair(59))
-
-                # Get some information about the log item
-                src_mac = log_item.display_src_mac()
-                src_ip = log_item.display_src_ip()
-
-                dst_mac = log_item.display_dst_mac()
-                dst_ip = log_item.display_dst_ip()
-
-                # Set the source color based on the direction/type
-                direction = log_item.log_type
-                if direction == 'inbound':
-                    color_set = color_set_red
-                elif direction == 'outbound':
-                    color_set = color_set_green
-                else:
-                    color_set = color_set_f_src
-
-                # Draw the source information
-                self.stdscr.addstr(i + 1, base_offset + 1, direction, curses.color_pair(color_set[0]))
-                self.stdscr.addstr(i + 1, base_offset + 10, src_mac, curses.color_pair(color_set[1]))
-                self.stdscr.addstr(i + 1, base_offset + 28, src_ip, curses.color_pair(color_set[2]))
-                self.stdscr.addstr(i + 1, base_offset + 28 + len(src_ip), f":{log_item.display_src_port()}", curses.color_pair(color_set[0]))
-
-                # Draw the destination information
-                if direction == 'inbound':
-                    color_set = color_set_green
-                elif direction == 'outbound':
-                    color_set = color_set_red
-                else:
-                    color_set = color_set_f_dst
-
-                self.stdscr.addstr(i + 1, base_offset + 50, dst_mac, curses.color_pair(color_set[1]))
-                self.stdscr.addstr(i + 1, base_offset + 68, dst_ip, curses.color_pair(color_set[2]))
-                self.stdscr.addstr(i + 1, base_offset + 68 + len(dst_ip), f":{log_item.display_dst_port()}", curses.color_pair(color_set[0]))
-
-        self.process_log_queue()
-        if not self.log_items:
+        """  Displays the log items, by moving the log pad viewport to the current offset. """
+        if not self.log_count:
             self.logger.info("No log items.")
             self.stdscr.addnstr(1, 1, 'No log items.', self.cols - 2)
             return
 
+        # Move off of dropped items
+        self.log_pos = max(self.log_pos, self.log_start)
+        self.log_offset = max(self.log_offset, self.log_start)
+
         # if the log position is greater than the current offset + the screen size, increase the offset
         # If the log position is less than the current offset, decrease the offset
         if self.log_pos >= self.log_offset + self.rows - 2:
             self.log_offset = self.log_pos - self.rows + 3
-            self.logger.debug("Log offset has been increased to %s" % self.log_offset)
+            self.logger.debug("Log offset has been increased to %s", self.log_offset)
         elif self.log_pos < self.log_offset:
             self.log_offset = self.log_pos
-            self.logger.debug("Log offset has been decreased to %s" % self.log_offset)
+            self.logger.debug("Log offset has been decreased to %s", self.log_offset)
+
+        self.update_log_pad()
 
-        display_log()
+        # Draws the arrow in the left margin
+        self.stdscr.addstr(self.log_pos - self.log_offset + 1, 0, '➤', self.color_pairs[6])
+        self.stdscr.noutrefresh()  # Stage stdscr first, so the pad is drawn over it
+        self.log_pad.noutrefresh(self.log_offset - self.pad_start, 1, 1, 1, self.rows - 2, self.cols - 2)
 
     def process_key_log_view(self, key):
         """  Processes the key presses in log view mode. """
-        self.logger.error(key)
         if key == 'KEY_UP':
-            self.log_pos = max(0, self.log_pos - 1)
-            self.logger.info("Log pos has been decreased to %s" % self.log_pos)
+            self.log_pos = max(self.log_start, self.log_pos - 1)
+            self.logger.info("Log pos has been decreased to %s", self.log_pos)
             return True
         elif key == 'KEY_DOWN':
-            self.log_pos = min(len(self.log_items) - 1 - self.rows, self.log_pos + 1)
-            self.logger.info("Log position has been increased to %s" % self.log_pos)
+            self.log_pos = min(self.log_count - 1, self.log_pos + 1)
+            self.logger.info("Log position has been increased to %s", self.log_pos)
             return True
         elif key == 'KEY_PPAGE':
-            self.log_pos = max(0, self.log_pos - self.rows)
-            self.logger.info("Log position has been decreased to %s" % self.log_pos)
+            self.log_pos = max(self.log_start, self.log_pos - self.rows)
+            self.logger.info("Log position has been decreased to %s", self.log_pos)
             return True
         elif key == 'KEY_NPAGE':
-            self.log_pos = min(len(self.log_items) - 1 - self.rows, self.log_pos + self.rows)
-            self.logger.info("Log position has been increased to %s" % self.log_pos)
+            self.log_pos = min(self.log_count - 1, self.log_pos + self.rows)
+            self.logger.info("Log position has been increased to %s", self.log_pos)
             return True
 
 
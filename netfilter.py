@@ -6,15 +6,18 @@ Dumpster reads netfilter logs, parses them, and then acts on them.
 __version__ = "0.0.3"
 
 from zenlib.logging import loggify
-from queue import Queue
+from queue import SimpleQueue, Empty
 from signal import signal, SIGUSR1
-from asyncio import sleep
+from asyncio import Event, sleep, get_running_loop, to_thread
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import read, strerror, O_NONBLOCK, O_CLOEXEC
 from os.path import isfile, exists
+from struct import unpack_from, calcsize
 from protocol_parser import ProtocolParser
 from service_parser import ServiceParser
 
 import tomllib
-import re
 
 
 @loggify
@@ -34,6 +37,7 @@ class NetFilterLogLine:
                      'SPT': 'Source port',
                      'DPT': 'Destination port',
                      'L4_LEN': 'Length of layer 4 portion'}
+    PARSED_PARAMETERS = tuple(param for param in NF_Parameters if '_LEN' not in param)  # Lengths aren't parsed
 
     NF_Flags = {'ACK': 'TCP Acknowledgement',
                 'FIN': 'TCP Finish',
@@ -47,53 +51,60 @@ class NetFilterLogLine:
                 'CE': 'TCP Congestion Experienced',
                 'DF': "Don't fragment",
                 }
+    FLAG_BITS = {flag: 1 << bit for bit, flag in enumerate(NF_Flags)}  # The bit set in self.flags for each flag
+
+    # Every attribute a parsed line can have, so instances don't need a __dict__
+    __slots__ = ('raw_line', 'aliases', 'protocols', 'services', 'logger', 'log_type', 'log_statement', 'hostname', 'timestamp',
+                 'IN', 'OUT', 'MAC', 'SRC', 'DST', 'TOS', 'PREC', 'TTL', 'ID', 'PROTO', 'SPT', 'DPT', 'SRC_MAC', 'DST_MAC',
+                 'flags', '_flags_str', '_str_cache')
 
     _MAC_special = {'multicast': '01:00:5e'}
 
-    def __init__(self, line, protocols=None, services=None, aliases=None, *args, **kwargs):
-        if not protocols:
-            protocols = ProtocolParser(logger=self.logger).protocols
+    def __init__(self, line, protocols, services, aliases=None, *args, **kwargs):
+        # The protocols and services are parsed once by the reader, instead of reading the system files for every line
         self.protocols = protocols
-        if not services:
-            services = ProtocolParser(logger=self.logger).services
         self.services = services
 
         self.raw_line = line.strip()
         self.aliases = aliases
         self.log_type = "forward"  # Default to forward
+        self._str_cache = None  # Set the first time the line is formatted, it doesn't change after parsing
         self.parse_line()
 
     def parse_line(self):
         """Parses the raw line"""
-        self.logger.debug("Parsing line: %s" % self.raw_line)
-        # Start by splitting the line using the "IN=" portion
-        if ' IN=' not in self.raw_line:
+        self.logger.debug("Parsing line: %s", self.raw_line)
+        # Start by splitting the line using the " IN=" portion
+        pre_in, sep, _ = self.raw_line.partition(' IN=')
+        if not sep:
             raise ValueError("Unable to process line as a netfilter line, missing 'IN=': %s" % self.raw_line)
-
-        pre_in = self.raw_line.split("IN=")[0]
         self._parse_pre_in(pre_in)
 
-        self.parse_flags()
+        # Split the rest of the line into KEY=VALUE parameters and bare flags in a single pass
+        params = {}
+        flags = set()
+        for token in self.raw_line[len(pre_in):].split():
+            name, sep, value = token.partition('=')
+            if sep:
+                params.setdefault(name, value)  # Keep the first value for repeated names
+            else:
+                flags.add(token)
+
+        self.parse_flags(flags)
 
         # Parse the packet based on the parameters
-        for param in self.NF_Parameters.keys():
-            # Don't parse length here
-            if "_LEN" in param:
-                continue
-            # Search for the parameter by looking for " {param}={value} "
-            re_pattern = r' %s=([\S]+)\s?' % param
-            match = re.search(re_pattern, self.raw_line)
-            if match:
+        for param in self.PARSED_PARAMETERS:
+            if value := params.get(param):
                 if param == 'MAC':
-                    self._parse_mac(match.group(1))
+                    self._parse_mac(value)
                 if param == 'PROTO':
                     # Check if the protocol is a number
-                    if match.group(1).isdigit():
-                        self.PROTO = self.protocols[match.group(1)]
+                    if value.isdigit():
+                        self.PROTO = self.protocols[value]
                     else:
-                        self.PROTO = match.group(1)
+                        self.PROTO = value
                 else:
-                    setattr(self, param, match.group(1))
+                    setattr(self, param, value)
             else:
                 if param == 'IN':
                     self.logger.debug("Input parameter not found, setting type to 'outbound'")
@@ -101,6 +112,10 @@ class NetFilterLogLine:
                 elif param == 'OUT':
                     self.logger.debug("Output parameter not found, setting type to 'inbound'")
                     self.log_type = 'inbound'
+                elif param == 'MAC':
+                    # Locally generated packets are logged without MAC addresses
+                    self.logger.debug("MAC parameter not found, leaving the MAC addresses unset")
+                    self.MAC = self.SRC_MAC = self.DST_MAC = None
                 elif param in ('SPT', 'DPT'):
                     if self.PROTO in ('TCP', 'UDP'):
                         raise ValueError("Port is unset when it should be set: %s" % self.raw_line)
@@ -108,62 +123,71 @@ class NetFilterLogLine:
                         self.logger.debug("Port is missing but protocol is not TCP or UDP, setting to '0'")
                         setattr(self, param, '0')
                 else:
-                    self.logger.warning("Unable to find parameter: %s" % param)
+                    self.logger.warning("Unable to find parameter: %s", param)
                     setattr(self, param, None)
 
-    def parse_flags(self):
+    def parse_flags(self, found_flags):
         """
-        Parses netfilter flags from self.raw_line
+        Sets the bit for each netfilter flag in self.flags, based on the set of flag tokens found in self.raw_line
         """
-        self.logger.debug("Parsing flags: %s" % self.raw_line)
-        for flag in self.NF_Flags.keys():
-            flag_re = r'\s%s[\s|$]' % flag
-            if re.search(flag_re, self.raw_line):
-                setattr(self, flag, True)
-            else:
-                setattr(self, flag, False)
+        self.logger.debug("Parsing flags: %s", found_flags)
+        self.flags = 0
+        flag_names = []
+        for flag, flag_name in self.NF_Flags.items():
+            if flag in found_flags:
+                self.flags |= self.FLAG_BITS[flag]
+                flag_names.append(flag_name)
+        self._flags_str = ", ".join(flag_names)
+
+    def has_flag(self, flag):
+        """ Returns True if the flag was set on the logged packet """
+        return bool(self.flags & self.FLAG_BITS[flag])
 
     def _parse_mac(self, mac):
         """
         Parses the MAC address based on how nftables logs it
-        SRCMAC:DSTMAC:TYPE
+        DSTMAC:SRCMAC:TYPE
         ex. AA:BB:CC:DD:EE:FF:AA:BB:CC:DD:EE:FF:08:00
         08:00 = ipv4
+        Each address is 17 characters, so they're sliced out of their fixed positions.
         """
-        self.logger.debug("Parsing MAC address: %s" % mac)
-        src_re = r'[0-9a-fA-F:]{18}([a-fA-F0-9]{2}(?:\:[a-fA-F0-9]{2}){5})'
-        dst_re = r'([a-fA-F0-9]{2}(?:\:[a-fA-F0-9]{2}){5})'
-
-        self.SRC_MAC = re.search(src_re, mac).group(1)
-        self.DST_MAC = re.search(dst_re, mac).group(1)
+        self.logger.debug("Parsing MAC address: %s", mac)
+        if len(mac) < 35 or mac[17] != ':':
+            raise ValueError("Unable to parse MAC addresses: %s" % mac)
+        self.DST_MAC = mac[0:17]
+        self.SRC_MAC = mac[18:35]
 
     def _parse_pre_in(self, pre_in):
         """Parses the pre-IN portion of the line"""
-        self.logger.debug("Parsing pre-IN portion: %s" % pre_in)
+        self.logger.debug("Parsing pre-IN portion: %s", pre_in)
 
         # Split the pre-in portion around the 'kernel:' portion
-        front, back = pre_in.split(" kernel: ")
+        front, sep, back = pre_in.partition(" kernel:")
+        if not sep:
+            raise ValueError("Unable to process line as a netfilter line, missing 'kernel:': %s" % self.raw_line)
         self.log_statement = back.strip()
 
-        # The hostname should be the last portion of the front
-        hostname = front.split(" ")[-1]
+        # The hostname should be the last portion of the front, the timestamp is everything before it
+        timestamp, _, hostname = front.rpartition(" ")
         self.hostname = hostname.strip()
-
-        # Get the timestamp by removing the hostname from the front
-        self.timestamp = front.replace(hostname, "").strip()
+        self.timestamp = timestamp.strip()
 
     def _display_mac(self, mac):
         """
         Formats a MAC address to be diplayed.
         Special mac types such as multicast take precedence over aliases.
+        A missing MAC address is displayed as an empty string.
         """
+        if mac is None:
+            return ""
+
         # If the MAC is a multicast, then return the special string
         for name, prefix in self._MAC_special.items():
             if mac.startswith(prefix):
                 return f"{name}{mac.replace(prefix,'').replace(':00', '')}"
 
-        if mac in self.aliases.get('mac_name').keys():
-            return f"@{self.aliases.get('mac_name').get(mac)}"
+        if (alias := self.aliases['mac_name'].get(mac)) is not None:
+            return f"@{alias}"
 
         return mac
 
@@ -172,8 +196,8 @@ class NetFilterLogLine:
         Formats an IP address to be displayed.
         If an alias exists, displays that alias with a @ in front of it.
         """
-        if ip in self.aliases.get('ip_name').keys():
-            return f"@{self.aliases.get('ip_name').get(ip)}"
+        if (alias := self.aliases['ip_name'].get(ip)) is not None:
+            return f"@{alias}"
 
         return ip
 
@@ -206,39 +230,41 @@ class NetFilterLogLine:
         Formats a port to be displayed.
         If a service defintion exists, displays that service with a @ in front of it.
         """
-        proto = proto.lower()
-        if proto in self.services and port in self.services[proto]:
-            return f"@{self.services[proto][port]}"
+        if (service := self.services.get(proto.lower(), {}).get(port)) is not None:
+            return f"@{service}"
         return port
 
     def __str__(self):
-        """ Returns a string representation of the object"""
-        log_type = f"<{self.log_type}>".ljust(10, ' ')
+        """ Returns a string representation of the object, formatted once and cached"""
+        if self._str_cache is not None:
+            return self._str_cache
+
         src_mac_alias = self._display_mac(self.SRC_MAC)
         src_ip_alias = self._display_ip(self.SRC)
         src_port_alias = self._display_port(self.SPT, self.PROTO)
-        src_str = f"({src_mac_alias}) {src_ip_alias}:{src_port_alias} ".ljust(46, ' ')
-
-        proto_str = f"-{self.PROTO}->".ljust(8, ' ')
 
         dst_mac_alias = self._display_mac(self.DST_MAC)
         dst_ip_alias = self._display_ip(self.DST)
         dst_port_alias = self._display_port(self.DPT, self.PROTO)
-        dst_str = f"({dst_mac_alias}) {dst_ip_alias}:{dst_port_alias} ".ljust(46, ' ')
-
-        flags = ""
-
-        for flag in self.NF_Flags.keys():
-            if getattr(self, flag):
-                flags += f"{self.NF_Flags[flag]}, "
-        flags = flags.rstrip(" ,")
 
-        return f"[{self.timestamp}] {log_type} {self.hostname}: {src_str} {proto_str} {dst_str} <{flags}>"
+        # Formatted in one pass, the widths pad each column like ljust
+        self._str_cache = "[%s] %-10s %s: %-46s %-8s %-46s <%s>" % (self.timestamp, f"<{self.log_type}>", self.hostname,
+                                                                    f"({src_mac_alias}) {src_ip_alias}:{src_port_alias} ",
+                                                                    f"-{self.PROTO}->",
+                                                                    f"({dst_mac_alias}) {dst_ip_alias}:{dst_port_alias} ",
+                                                                    self._flags_str)
+        return self._str_cache
 
 
 @loggify
 class NetfilterLogReader:
-    """Reads Netfilter logs, parses into a Queue"""
+    """Reads Netfilter logs, parses into a Queue of lists of log items"""
+    LOG_BATCH_SIZE = 64  # Maximum number of log items put in the queue at once
+    LOG_READ_SIZE = 65536  # Number of bytes read from a log file at once
+    MAX_QUEUED_BATCHES = 256  # Number of batches kept in the queue, the oldest are dropped first
+    IN_MODIFY = 0x00000002  # inotify mask for a file being written to
+    INOTIFY_EVENT = 'iIII'  # struct inotify_event, without the name following it
+
     def __init__(self, config_file='config.toml', *args, **kwargs):
         signal(SIGUSR1, self._reload_files)
         self.config_file = config_file
@@ -248,7 +274,10 @@ class NetfilterLogReader:
         # Get the service config from the service file
         self.services = ServiceParser(self.config['source_files'].get('service_file'), logger=self.logger).services
 
-        self.log_items = Queue()
+        self.log_items = SimpleQueue()
+        self.log_event = Event()  # Set when items are added to the queue
+        self.inotify_fd = -1  # Set up by watch_logs, once the event loop is running
+        self.log_changed = {}  # inotify watch descriptor: Event set when that log file is written to
 
     def run(self):
         from asyncio import get_event_loop
@@ -256,7 +285,7 @@ class NetfilterLogReader:
 
     def read_config(self):
         """ Reads the config file. """
-        self.logger.info("Reading config file: %s" % self.config_file)
+        self.logger.info("Reading config file: %s", self.config_file)
         with open(self.config_file, 'rb') as f:
             self.config = tomllib.load(f)
         self.log_files = self.config['log_files']
@@ -264,27 +293,110 @@ class NetfilterLogReader:
     def watch_logs(self):
         """Watches the log files"""
         from asyncio import create_task
+        self._init_inotify()
         [create_task(self.watch_log(log_file)) for log_file in self.log_files.values()]
 
     async def watch_log(self, log_file):
-        """Reads the log file, parses it, and puts it in the queue"""
+        """
+        Reads the log file, parses it, and puts it in the queue.
+        The file is read as bytes, LOG_READ_SIZE at a time, and split into lines.
+        It's opened unbuffered, so each read is a single read() call instead of going through another buffer.
+        A partial line at the end of the file is held until the rest of it is written.
+        Lines are parsed in batches of up to LOG_BATCH_SIZE lines, in a worker thread so parsing doesn't hold up the event loop,
+        then the parsed items are put in the queue as a list.
+        """
         if not exists(log_file) or not isfile(log_file):
             raise FileNotFoundError("Log file does not exist: %s" % log_file)
 
-        with open(log_file, 'r') as f:
-            self.logger.info("Watching log file: %s" % f.name)
+        log_changed = self._watch_file(log_file)
+        with open(log_file, 'rb', buffering=0) as f:
+            self.logger.info("Watching log file: %s", f.name)
+            partial = b''
             while True:
-                if line := f.readline():
-                    try:
-                        log_item = NetFilterLogLine(line, protocols=self.protocols, services=self.services, aliases=self.config['aliases'],
-                                                    logger=self.logger, _log_init=False)
-                        self.log_items.put(log_item)
-                        self.logger.debug("Added log line to queue: %s" % log_item)
-                    except ValueError as e:
-                        self.logger.error(e)
+                if data := f.read(self.LOG_READ_SIZE):
+                    *lines, partial = (partial + data).split(b'\n')
+                    for start in range(0, len(lines), self.LOG_BATCH_SIZE):
+                        if batch := await to_thread(self.parse_lines, lines[start:start + self.LOG_BATCH_SIZE]):
+                            self.log_items.put(batch)
+                            self._drop_old_batches()
+                            self.log_event.set()
+                    continue  # Keep reading until the end of the file
+                elif log_changed:
+                    await log_changed.wait()  # Wait for more lines at the end of the file
+                    log_changed.clear()
                 else:
-                    await sleep(0.1)
-        self.logger.info("Closed log file: %s" % log_file)
+                    await sleep(0.1)  # Poll for more lines without inotify
+        self.logger.info("Closed log file: %s", log_file)
+
+    def parse_lines(self, lines):
+        """ Parses raw log lines, as bytes, into a list of log items, skipping lines which aren't netfilter lines """
+        batch = []
+        for line in lines:
+            if not line:
+                continue
+            line = line.decode(errors='replace')
+            try:
+                log_item = NetFilterLogLine(line, protocols=self.protocols, services=self.services, aliases=self.config['aliases'],
+                                            logger=self.logger, _log_init=False)
+            except ValueError as e:
+                self.logger.error(e)
+                continue
+            batch.append(log_item)
+            self.logger.debug("Added log line to batch: %s", log_item)  # Only formatted if debug logging is enabled
+        return batch
+
+    def _drop_old_batches(self):
+        """ Drops the oldest batches while more than MAX_QUEUED_BATCHES are queued, so the queue is bounded even if it isn't read """
+        dropped = 0
+        try:
+            while self.log_items.qsize() > self.MAX_QUEUED_BATCHES:
+                dropped += len(self.log_items.get_nowait())
+        except Empty:
+            pass
+        if dropped:
+            self.logger.warning("Log queue full, dropped %s log items.", dropped)
+
+    def _init_inotify(self):
+        """
+        Creates an inotify instance, read by the event loop, so log files can be waited on instead of polled.
+        Log files are polled if inotify isn't available.
+        """
+        try:
+            self._libc = CDLL(find_library('c'), use_errno=True)
+            self.inotify_fd = self._libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            self.logger.warning("Unable to use inotify, polling log files: %s", e)
+            return
+
+        if self.inotify_fd < 0:
+            self.logger.warning("Unable to initialize inotify, polling log files: %s", strerror(get_errno()))
+            return
+        get_running_loop().add_reader(self.inotify_fd, self._on_inotify)
+
+    def _watch_file(self, log_file):
+        """ Adds an inotify watch for the log file, returns the Event set when it's written to, or None if it can't be watched """
+        if self.inotify_fd < 0:
+            return None
+
+        watch = self._libc.inotify_add_watch(self.inotify_fd, log_file.encode(), self.IN_MODIFY)
+        if watch < 0:
+            self.logger.warning("Unable to watch log file, polling it: %s", strerror(get_errno()))
+            return None
+        return self.log_changed.setdefault(watch, Event())
+
+    def _on_inotify(self):
+        """ Reads the pending inotify events, called by the event loop when the inotify fd is readable """
+        try:
+            events = read(self.inotify_fd, 4096)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(events):
+            watch, mask, cookie, name_len = unpack_from(self.INOTIFY_EVENT, events, offset)
+            offset += calcsize(self.INOTIFY_EVENT) + name_len
+            if log_changed := self.log_changed.get(watch):
+                log_changed.set()
 
     def _reload_files(self, *args, **kwargs):
         """ Reloads watched log files """
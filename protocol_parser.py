@@ -6,6 +6,8 @@ Each line contains the protocol name, protocol number, and protocol aliases sepa
 
 __version__ = "1.0.0"
 
+from logging import DEBUG
+
 from zenlib.logging import loggify
 
 
@@ -19,16 +21,17 @@ class ProtocolParser:
     def parse_protocols_file(self):
         """ Parses the protocols file and stores the results in the self.protocols dict.
         The dict keys are the protocol numbers, and the values are the protocol aliases. """
+        debug = self.logger.isEnabledFor(DEBUG)  # Checked once, instead of calling the logger for every line
         with open(self.protocols_file, 'r') as f:
             for line in f:
                 if line.startswith('#'):
                     continue
-                line = line.strip()
-                if not line:
+                fields = line.split(None, 2)  # Split once, the aliases and comments are left in the last field
+                if len(fields) < 2:
                     continue
-                protocol_name = line.split()[0]
-                protocol_number = line.split()[1]
-                self.logger.debug("Adding protocol %s with number %s", protocol_name, protocol_number)
+                protocol_name, protocol_number = fields[0], fields[1]
+                if debug:
+                    self.logger.debug("Adding protocol %s with number %s", protocol_name, protocol_number)
                 self.protocols[protocol_number] = protocol_name
 
     def __str__(self):
@@ -8,6 +8,8 @@ Each line contains the service name, then the port and protocol type like:
 __version__ = "1.0.0"
 
 
+from logging import DEBUG
+
 from zenlib.logging import loggify
 
 
@@ -23,20 +25,19 @@ class ServiceParser:
         The key name is the protocol, which contians a dict with:
             key: port
             value: service name (lowercase)"""
+        debug = self.logger.isEnabledFor(DEBUG)  # Checked once, instead of calling the logger for every line
         with open(self.service_file, 'r') as f:
             for line in f:
                 if line.startswith('#'):
                     continue
-                line = line.strip()
-                if not line:
+                fields = line.split(None, 2)  # Split once, the aliases and comments are left in the last field
+                if len(fields) < 2:
                     continue
-                service = line.split()[0]
-                port = line.split()[1].split('/')[0]
-                protocol = line.split()[1].split('/')[1]
-                if protocol not in self.services:
-                    self.services[protocol] = {}
-                self.logger.debug("Adding service: %s %s/%s", service, port, protocol)
-                self.services[protocol][port] = service.lower()
+                service, port_protocol = fields[0], fields[1]
+                port, _, protocol = port_protocol.partition('/')
+                if debug:
+                    self.logger.debug("Adding service: %s %s/%s", service, port, protocol)
+                self.services.setdefault(protocol, {})[port] = service.lower()
 
     def __str__(self):
         out_str = ''